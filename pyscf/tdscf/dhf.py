@@ -20,7 +20,6 @@
 TDA and TDHF for no-pair DKS Hamiltonian
 '''
 
-from functools import reduce
 import numpy
 from pyscf import lib
 from pyscf import dft
@@ -48,28 +47,36 @@ def gen_tda_operation(mf, fock_ao=None):
     nvir = len(viridx)
     orbv = mo_coeff[:,viridx]
     orbo = mo_coeff[:,occidx]
+    orbv_c = orbv.conj()
+    orbo_c = orbo.conj()
 
     if fock_ao is None:
         #dm0 = mf.make_rdm1(mo_coeff, mo_occ)
         #fock_ao = mf.get_hcore() + mf.get_veff(mol, dm0)
-        foo = numpy.diag(mo_energy[occidx])
-        fvv = numpy.diag(mo_energy[viridx])
+        e_ia = mo_energy[viridx] - mo_energy[occidx,None]
+        hdiag = e_ia.ravel()
     else:
-        fock = reduce(numpy.dot, (mo_coeff.conj().T, fock_ao, mo_coeff))
-        foo = fock[occidx[:,None],occidx]
-        fvv = fock[viridx[:,None],viridx]
-    hdiag = (fvv.diagonal() - foo.diagonal()[:,None]).ravel()
+        # Only the occupied-occupied and virtual-virtual blocks are needed
+        foo = orbo_c.T.dot(fock_ao).dot(orbo)
+        fvv = orbv_c.T.dot(fock_ao).dot(orbv)
+        hdiag = (fvv.diagonal() - foo.diagonal()[:,None]).ravel()
 
     mo_coeff = numpy.asarray(numpy.hstack((orbo,orbv)), order='F')
     vresp = mf.gen_response(hermi=0)
 
     def vind(zs):
         zs = numpy.asarray(zs).reshape(-1,nocc,nvir)
-        dmov = lib.einsum('xov,qv,po->xpq', zs, orbv.conj(), orbo)
+        # dmov = einsum('xov,qv,po->xpq', zs, orbv.conj(), orbo)
+        dmov = numpy.tensordot(zs, orbv_c, axes=([2],[1]))
+        dmov = numpy.tensordot(orbo, dmov, axes=([1],[1])).transpose(1,0,2)
         v1ao = vresp(dmov)
-        v1ov = lib.einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
-        v1ov += lib.einsum('xqs,sp->xqp', zs, fvv)
-        v1ov -= lib.einsum('xpr,sp->xsr', zs, foo)
+        # v1ov = einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
+        v1ov = numpy.matmul(numpy.matmul(orbo_c.T, v1ao), orbv)
+        if fock_ao is None:
+            v1ov += zs * e_ia
+        else:
+            v1ov += numpy.tensordot(zs, fvv, axes=([2],[0]))
+            v1ov -= numpy.tensordot(foo, zs, axes=([1],[1])).transpose(1,0,2)
         return v1ov.reshape(v1ov.shape[0], -1)
 
     return vind, hdiag
@@ -415,13 +422,12 @@ class TDA(TDBase):
         nov = e_ia.size
         nstates = min(nstates, nov)
         e_ia = e_ia.ravel()
-        e_threshold = numpy.sort(e_ia)[nstates-1]
+        e_threshold = numpy.partition(e_ia, nstates-1)[nstates-1]
         e_threshold += self.deg_eia_thresh
 
         idx = numpy.where(e_ia <= e_threshold)[0]
         x0 = numpy.zeros((idx.size, nov))
-        for i, j in enumerate(idx):
-            x0[i, j] = 1  # Koopmans' excitations
+        x0[numpy.arange(idx.size), idx] = 1  # Koopmans' excitations
         return x0
 
     def kernel(self, x0=None, nstates=None):
@@ -488,11 +494,11 @@ def gen_tdhf_operation(mf, fock_ao=None):
     nvir = len(viridx)
     orbv = mo_coeff[:,viridx]
     orbo = mo_coeff[:,occidx]
+    orbv_c = orbv.conj()
+    orbo_c = orbo.conj()
 
-    foo = numpy.diag(mo_energy[occidx])
-    fvv = numpy.diag(mo_energy[viridx])
-    hdiag = fvv.diagonal() - foo.diagonal()[:,None]
-    hdiag = numpy.hstack((hdiag.ravel(), -hdiag.ravel())).real
+    e_ia = mo_energy[viridx] - mo_energy[occidx,None]
+    hdiag = numpy.hstack((e_ia.ravel(), -e_ia.ravel())).real
 
     mo_coeff = numpy.asarray(numpy.hstack((orbo,orbv)), order='F')
     vresp = mf.gen_response(hermi=0)
@@ -501,16 +507,21 @@ def gen_tdhf_operation(mf, fock_ao=None):
         xys = numpy.asarray(xys).reshape(-1,2,nocc,nvir)
         xs, ys = xys.transpose(1,0,2,3)
         # dms = AX + BY
-        dms  = lib.einsum('xov,qv,po->xpq', xs, orbv.conj(), orbo)
-        dms += lib.einsum('xov,pv,qo->xpq', ys, orbv, orbo.conj())
+        # dms = einsum('xov,qv,po->xpq', xs, orbv.conj(), orbo)
+        #     + einsum('xov,pv,qo->xpq', ys, orbv, orbo.conj())
+        dms = numpy.tensordot(xs, orbv_c, axes=([2],[1]))
+        dms = numpy.tensordot(orbo, dms, axes=([1],[1])).transpose(1,0,2)
+        dmy = numpy.tensordot(ys, orbv, axes=([2],[1]))
+        dms += numpy.tensordot(orbo_c, dmy, axes=([1],[1])).transpose(1,2,0)
 
         v1ao = vresp(dms)
-        v1ov = lib.einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
-        v1vo = lib.einsum('xpq,qo,pv->xov', v1ao, orbo, orbv.conj())
-        v1ov += lib.einsum('xqs,sp->xqp', xs, fvv)  # AX
-        v1ov -= lib.einsum('xpr,sp->xsr', xs, foo)  # AX
-        v1vo += lib.einsum('xqs,sp->xqp', ys, fvv.conj())  # (A*)Y
-        v1vo -= lib.einsum('xpr,sp->xsr', ys, foo.conj())  # (A*)Y
+        # v1ov = einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
+        # v1vo = einsum('xpq,qo,pv->xov', v1ao, orbo, orbv.conj())
+        v1ov = numpy.matmul(numpy.matmul(orbo_c.T, v1ao), orbv)
+        v1vo = numpy.matmul(orbv_c.T, numpy.matmul(v1ao, orbo))
+        v1vo = v1vo.transpose(0,2,1)
+        v1ov += xs * e_ia  # AX
+        v1vo += ys * e_ia  # (A*)Y
 
         # (AX, (-A*)Y)
         nz = xys.shape[0]
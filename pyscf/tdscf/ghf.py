@@ -22,7 +22,6 @@
 #
 
 
-from functools import reduce
 import numpy
 from pyscf import lib
 from pyscf import dft
@@ -37,8 +36,35 @@ from pyscf import __config__
 
 OUTPUT_THRESHOLD = getattr(__config__, 'tdscf_rhf_get_nto_threshold', 0.3)
 REAL_EIG_THRESHOLD = getattr(__config__, 'tdscf_rhf_TDDFT_pick_eig_threshold', 1e-4)
+XC_SINGLE_PREC = getattr(__config__, 'tdscf_ghf_get_ab_xc_single_prec', False)
 
 
+def _gen_vresp(mf):
+    '''Response function for the (non-Hermitian) transition density matrices
+    generated in vind.
+
+    For real orbitals and pure collinear functionals, the Coulomb and XC
+    responses to a real antisymmetric density matrix vanish. Only the
+    symmetric part of the density matrices is then needed, and the response
+    can be computed with hermi=1.
+    '''
+    if not (mf.mo_coeff.dtype == numpy.double and
+            isinstance(mf, dft.KohnShamDFT) and mf.collinear[0] == 'c' and
+            not mf._numint.libxc.is_hybrid_xc(mf.xc)):
+        return mf.gen_response(hermi=0)
+
+    vresp = mf.gen_response(hermi=1)
+    def vresp_sym(dm1):
+        if dm1.dtype == numpy.double:
+            return vresp((dm1 + dm1.transpose(0,2,1)) * .5)
+        # The response function is linear. The real and imaginary parts are
+        # handled as real density matrices in the same batch.
+        n_dm = dm1.shape[0]
+        dm1 = numpy.vstack((dm1.real, dm1.imag))
+        v1 = vresp((dm1 + dm1.transpose(0,2,1)) * .5)
+        return v1[:n_dm] + v1[n_dm:] * 1j
+    return vresp_sym
+
 def gen_tda_operation(mf, fock_ao=None, wfnsym=None):
     '''A x
 
@@ -51,12 +77,14 @@ def gen_tda_operation(mf, fock_ao=None, wfnsym=None):
     mo_energy = mf.mo_energy
     mo_occ = mf.mo_occ
     nao, nmo = mo_coeff.shape
-    occidx = numpy.where(mo_occ == 1)[0]
-    viridx = numpy.where(mo_occ == 0)[0]
+    occidx = (mo_occ == 1).nonzero()[0]
+    viridx = (mo_occ == 0).nonzero()[0]
     nocc = len(occidx)
     nvir = len(viridx)
     orbv = mo_coeff[:,viridx]
     orbo = mo_coeff[:,occidx]
+    orbv_c = orbv.conj()
+    orbo_c = orbo.conj()
 
     if wfnsym is not None and mol.symmetry:
         if isinstance(wfnsym, str):
@@ -65,90 +93,154 @@ def gen_tda_operation(mf, fock_ao=None, wfnsym=None):
         orbsym = ghf_symm.get_orbsym(mol, mo_coeff)
         orbsym_in_d2h = numpy.asarray(orbsym) % 10  # convert to D2h irreps
         sym_forbid = (orbsym_in_d2h[occidx,None] ^ orbsym_in_d2h[viridx]) != wfnsym
+        sym_allowed = ~sym_forbid
+        # Scratch buffer for the symmetry restricted trial vectors
+        sym_buf = numpy.empty(0)
 
     if fock_ao is None:
         #dm0 = mf.make_rdm1(mo_coeff, mo_occ)
         #fock_ao = mf.get_hcore() + mf.get_veff(mol, dm0)
-        foo = numpy.diag(mo_energy[occidx])
-        fvv = numpy.diag(mo_energy[viridx])
+        # The Fock matrix is diagonal in the canonical MO basis. Its
+        # contribution to A x is a scaling of x by the orbital energy gaps.
+        e_ia = mo_energy[viridx] - mo_energy[occidx,None]
+        hdiag = e_ia.copy()
     else:
-        fock = reduce(numpy.dot, (mo_coeff.conj().T, fock_ao, mo_coeff))
-        foo = fock[occidx[:,None],occidx]
-        fvv = fock[viridx[:,None],viridx]
+        # Only the occupied-occupied and virtual-virtual blocks are needed
+        foo = orbo_c.T.dot(fock_ao).dot(orbo)
+        fvv = orbv_c.T.dot(fock_ao).dot(orbv)
+        hdiag = fvv.diagonal() - foo.diagonal()[:,None]
 
-    hdiag = fvv.diagonal() - foo.diagonal()[:,None]
     if wfnsym is not None and mol.symmetry:
         hdiag[sym_forbid] = 0
     hdiag = hdiag.ravel().real
 
     mo_coeff = numpy.asarray(numpy.hstack((orbo,orbv)), order='F')
-    vresp = mf.gen_response(hermi=0)
+    vresp = _gen_vresp(mf)
 
     def vind(zs):
+        nonlocal sym_buf
         zs = numpy.asarray(zs).reshape(-1,nocc,nvir)
         if wfnsym is not None and mol.symmetry:
-            zs = numpy.copy(zs)
-            zs[:,sym_forbid] = 0
-
-        dmov = lib.einsum('xov,qv,po->xpq', zs, orbv.conj(), orbo)
+            if sym_buf.dtype != zs.dtype or sym_buf.size < zs.size:
+                sym_buf = numpy.empty(zs.size, zs.dtype)
+            zs = numpy.multiply(zs, sym_allowed,
+                                out=sym_buf[:zs.size].reshape(zs.shape))
+
+        # dmov = einsum('xov,qv,po->xpq', zs, orbv.conj(), orbo)
+        dmov = numpy.tensordot(zs, orbv_c, axes=([2],[1]))
+        dmov = numpy.tensordot(orbo, dmov, axes=([1],[1])).transpose(1,0,2)
         v1ao = vresp(dmov)
-        v1ov = lib.einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
-        v1ov += lib.einsum('xqs,sp->xqp', zs, fvv)
-        v1ov -= lib.einsum('xpr,sp->xsr', zs, foo)
+        dtype = numpy.result_type(zs, v1ao, orbv)
+        if fock_ao is None:
+            v1ov = numpy.multiply(zs, e_ia, dtype=dtype)
+        else:
+            v1ov = numpy.tensordot(zs, fvv, axes=([2],[0])).astype(dtype, copy=False)
+            v1ov -= numpy.tensordot(foo, zs, axes=([1],[1])).transpose(1,0,2)
+        # v1ov += einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
+        # The last GEMM accumulates onto v1ov
+        nz = zs.shape[0]
+        v1ao = numpy.matmul(orbo_c.T, v1ao)
+        v1ov = lib.dot(v1ao.reshape(-1,nao), orbv, 1, v1ov.reshape(-1,nvir), 1)
+        v1ov = v1ov.reshape(nz,nocc,nvir)
         if wfnsym is not None and mol.symmetry:
-            v1ov[:,sym_forbid] = 0
-        return v1ov.reshape(v1ov.shape[0],-1)
+            v1ov *= sym_allowed
+        return v1ov.reshape(nz,-1)
 
     return vind, hdiag
 gen_tda_hop = gen_tda_operation
 
-def get_ab(mf, mo_energy=None, mo_coeff=None, mo_occ=None):
+def get_ab(mf, mo_energy=None, mo_coeff=None, mo_occ=None,
+           xc_single_prec=XC_SINGLE_PREC):
     r'''A and B matrices for TDDFT response function.
 
     A[i,a,j,b] = \delta_{ab}\delta_{ij}(E_a - E_i) + (ia||bj)
     B[i,a,j,b] = (ia||jb)
+
+    Kwargs:
+        xc_single_prec : bool
+            Whether to evaluate the XC kernel contributions on the integration
+            grids in single precision. The results are accumulated in double
+            precision. The errors introduced are typically much smaller
+            than the numerical integration errors.
     '''
     if mo_energy is None: mo_energy = mf.mo_energy
     if mo_coeff is None: mo_coeff = mf.mo_coeff
     if mo_occ is None: mo_occ = mf.mo_occ
 
     mol = mf.mol
-    nmo = mo_occ.size
     nao = mol.nao
-    occidx = numpy.where(mo_occ==1)[0]
-    viridx = numpy.where(mo_occ==0)[0]
+    occidx = (mo_occ==1).nonzero()[0]
+    viridx = (mo_occ==0).nonzero()[0]
     orbv = mo_coeff[:,viridx]
     orbo = mo_coeff[:,occidx]
     nvir = orbv.shape[1]
     nocc = orbo.shape[1]
-    mo = numpy.hstack((orbo,orbv))
-    moa = mo[:nao].copy()
-    mob = mo[nao:].copy()
-    orboa = orbo[:nao]
-    orbob = orbo[nao:]
-    nmo = nocc + nvir
+    # The occupied orbitals only enter the XC kernel contributions as complex
+    # conjugates. They are conjugated once here rather than on every grid
+    # block, and real orbitals are used as they are.
+    if numpy.iscomplexobj(mo_coeff):
+        mo = numpy.hstack((orbo.conj(),orbv))
+    else:
+        mo = numpy.hstack((orbo,orbv))
+    moa = mo[:nao]
+    mob = mo[nao:]
 
     e_ia = lib.direct_sum('a-i->ia', mo_energy[viridx], mo_energy[occidx])
-    a = numpy.diag(e_ia.ravel()).reshape(nocc,nvir,nocc,nvir).astype(mo_coeff.dtype)
+    a = numpy.diag(e_ia.ravel()).reshape(nocc,nvir,nocc,nvir)
+    # A is accumulated in place. It needs to be complex for complex orbitals.
+    # No copy is made for real orbitals.
+    a = a.astype(mo_coeff.dtype, copy=False)
     b = numpy.zeros_like(a)
 
     def add_hf_(a, b, hyb=1):
         if mo_coeff.dtype == numpy.double:
-            eri_mo  = ao2mo.general(mol, [orboa,moa,moa,moa], compact=False)
-            eri_mo += ao2mo.general(mol, [orbob,mob,mob,mob], compact=False)
-            eri_mo += ao2mo.general(mol, [orboa,moa,mob,mob], compact=False)
-            eri_mo += ao2mo.general(mol, [orbob,mob,moa,moa], compact=False)
-            eri_mo = eri_mo.reshape(nocc,nmo,nmo,nmo)
+            def get_eri_mo(c1, c2, c3, c4):
+                shape = [c.shape[1] for c in (c1, c2, c3, c4)]
+                ca = [c[:nao] for c in (c1, c2, c3, c4)]
+                cb = [c[nao:] for c in (c1, c2, c3, c4)]
+                eri_mo  = ao2mo.general(mol, ca, compact=False)
+                eri_mo += ao2mo.general(mol, cb, compact=False)
+                eri_mo += ao2mo.general(mol, ca[:2]+cb[2:], compact=False)
+                eri_mo += ao2mo.general(mol, cb[:2]+ca[2:], compact=False)
+                return eri_mo.reshape(shape)
+            # Only the (ov|ov) and (oo|vv) blocks are needed. For real
+            # orbitals (ia|bj) = (ia|jb), so (ov|vo) is not transformed.
+            ca = [orbo[:nao], orbv[:nao]]
+            cb = [orbo[nao:], orbv[nao:]]
+            eri_ovov  = ao2mo.general(mol, ca+ca, compact=False)
+            eri_ovov += ao2mo.general(mol, cb+cb, compact=False)
+            eri_ovov = eri_ovov.reshape(nocc,nvir,nocc,nvir)
+            # (ov_b|ov_a) is the transpose of (ov_a|ov_b)
+            eri_ab = ao2mo.general(mol, ca+cb, compact=False)
+            eri_ab = eri_ab.reshape(nocc,nvir,nocc,nvir)
+            eri_ovov += eri_ab
+            eri_ovov += eri_ab.transpose(2,3,0,1)
+            eri_ab = None
+            eri_oovv = get_eri_mo(orbo, orbo, orbv, orbv)
+            a += eri_ovov
         else:
             eri_ao = mol.intor('int2e').reshape([nao]*4)
-            eri_mo_a = lib.einsum('pqrs,pi,qj->ijrs', eri_ao, orboa.conj(), moa)
-            eri_mo_a+= lib.einsum('pqrs,pi,qj->ijrs', eri_ao, orbob.conj(), mob)
-            eri_mo = lib.einsum('ijrs,rk,sl->ijkl', eri_mo_a, moa.conj(), moa)
-            eri_mo+= lib.einsum('ijrs,rk,sl->ijkl', eri_mo_a, mob.conj(), mob)
-        a += numpy.einsum('iabj->iajb', eri_mo[:nocc,nocc:,nocc:,:nocc])
-        a -= numpy.einsum('ijba->iajb', eri_mo[:nocc,:nocc,nocc:,nocc:]) * hyb
-        b += numpy.einsum('iajb->iajb', eri_mo[:nocc,nocc:,:nocc,nocc:])
-        b -= numpy.einsum('jaib->iajb', eri_mo[:nocc,nocc:,:nocc,nocc:]) * hyb
+            def half_trans(c1, c2):
+                eri_mo_a = lib.einsum('pqrs,pi,qj->ijrs', eri_ao, c1[:nao].conj(), c2[:nao])
+                eri_mo_a+= lib.einsum('pqrs,pi,qj->ijrs', eri_ao, c1[nao:].conj(), c2[nao:])
+                return eri_mo_a
+            def full_trans(eri_mo_a, c3, c4):
+                eri_mo = lib.einsum('ijrs,rk,sl->ijkl', eri_mo_a, c3[:nao].conj(), c4[:nao])
+                eri_mo+= lib.einsum('ijrs,rk,sl->ijkl', eri_mo_a, c3[nao:].conj(), c4[nao:])
+                return eri_mo
+            # Only the (ov|vo), (oo|vv) and (ov|ov) blocks are needed. The
+            # (ov| half-transformed integrals are shared by (ov|vo) and (ov|ov).
+            eri_ov = half_trans(orbo, orbv)
+            eri_ovvo = full_trans(eri_ov, orbv, orbo)
+            eri_ovov = full_trans(eri_ov, orbo, orbv)
+            eri_ov = None
+            eri_oovv = full_trans(half_trans(orbo, orbo), orbv, orbv)
+            a += eri_ovvo.transpose(0,1,3,2)
+            eri_ovvo = None
+        a -= eri_oovv.transpose(0,3,1,2) * hyb
+        eri_oovv = None
+        b += eri_ovov
+        b -= eri_ovov.transpose(2,1,0,3) * hyb
         return a, b
 
     if isinstance(mf, dft.KohnShamDFT):
@@ -174,16 +266,62 @@ def get_ab(mf, mo_energy=None, mo_coeff=None, mo_occ=None):
         mem_now = lib.current_memory()[0]
         max_memory = max(2000, mf.max_memory*.8-mem_now)
 
+        # For real orbitals the MO values are real. The multi-collinear
+        # orbital products become complex (complex64 in single precision)
+        # in ud2tm.
+        if xc_single_prec:
+            if mo_coeff.dtype == numpy.double:
+                xc_dtype = numpy.float32
+            else:
+                xc_dtype = numpy.complex64
+        else:
+            xc_dtype = mo_coeff.dtype
+
         def get_mo_value(ao):
+            # mo_oa and mo_ob hold the conjugated occupied orbital values
             if ao.ndim == 2:
-                mo_a = lib.einsum('rp,pi->ri', ao, moa)
-                mo_b = lib.einsum('rp,pi->ri', ao, mob)
+                mo_a = lib.einsum('rp,pi->ri', ao, moa).astype(xc_dtype, copy=False)
+                mo_b = lib.einsum('rp,pi->ri', ao, mob).astype(xc_dtype, copy=False)
                 return mo_a[:,:nocc], mo_a[:,nocc:], mo_b[:,:nocc], mo_b[:,nocc:]
             else:
-                mo_a = lib.einsum('xrp,pi->xri', ao, moa)
-                mo_b = lib.einsum('xrp,pi->xri', ao, mob)
+                mo_a = lib.einsum('xrp,pi->xri', ao, moa).astype(xc_dtype, copy=False)
+                mo_b = lib.einsum('xrp,pi->xri', ao, mob).astype(xc_dtype, copy=False)
                 return mo_a[:,:,:nocc], mo_a[:,:,nocc:], mo_b[:,:,:nocc], mo_b[:,:,nocc:]
 
+        def contract_fxc(wfxc, rho_ov):
+            # numpy.einsum('txsyr,txria->syria', wfxc, rho_ov) evaluated as a
+            # matrix multiplication for each grid point. The products are
+            # written to w_ov in the layout of rho_ov. Grid points are
+            # processed in small batches to bound the copies matmul makes
+            # for the strided operands.
+            shape = rho_ov.shape
+            ngrid = shape[-3]
+            nvar = rho_ov.size // (ngrid * nocc * nvir)
+            wfxc = wfxc.reshape(nvar,nvar,ngrid).transpose(2,1,0)
+            wfxc = wfxc.astype(rho_ov.real.dtype, copy=False)
+            rho_ov = rho_ov.reshape(nvar,ngrid,nocc*nvir)
+            w_ov = numpy.empty_like(rho_ov)
+            for p0, p1 in lib.prange(0, ngrid, 64):
+                numpy.matmul(wfxc[p0:p1], rho_ov[:,p0:p1].transpose(1,0,2),
+                             out=w_ov[:,p0:p1].transpose(1,0,2))
+            return w_ov.reshape(shape)
+
+        def contract_ab(w_ov, rho_ov):
+            # XC contributions to A and B
+            #   lib.einsum('...ia,...jb->iajb', w_ov, rho_ov.conj())
+            #   lib.einsum('...ia,...jb->iajb', w_ov, rho_ov)
+            # each evaluated as a single GEMM
+            nov = nocc * nvir
+            w_ov = w_ov.reshape(-1,nov).T
+            rho_ov = rho_ov.reshape(-1,nov)
+            b_xc = lib.dot(w_ov, rho_ov).reshape(nocc,nvir,nocc,nvir)
+            if numpy.isrealobj(rho_ov):
+                # rho_vo == rho_ov for real orbitals
+                a_xc = b_xc
+            else:
+                a_xc = lib.dot(w_ov, rho_ov.conj()).reshape(nocc,nvir,nocc,nvir)
+            return a_xc, b_xc
+
         def ud2tm(aa, ab, ba, bb):
             return numpy.stack([aa + bb,        # rho
                                 ba + ab,        # mx
@@ -201,31 +339,27 @@ def get_ab(mf, mo_energy=None, mo_coeff=None, mo_occ=None):
                     wfxc = weight * fxc.reshape(4,4,-1)
                     wr, wmx, wmy, wmz = weight * fxc.reshape(4,4,-1)
                     mo_oa, mo_va, mo_ob, mo_vb = get_mo_value(ao)
-                    rho_ov_aa = numpy.einsum('ri,ra->ria', mo_oa.conj(), mo_va)
-                    rho_ov_ab = numpy.einsum('ri,ra->ria', mo_oa.conj(), mo_vb)
-                    rho_ov_ba = numpy.einsum('ri,ra->ria', mo_ob.conj(), mo_va)
-                    rho_ov_bb = numpy.einsum('ri,ra->ria', mo_ob.conj(), mo_vb)
+                    rho_ov_aa = numpy.einsum('ri,ra->ria', mo_oa, mo_va)
+                    rho_ov_ab = numpy.einsum('ri,ra->ria', mo_oa, mo_vb)
+                    rho_ov_ba = numpy.einsum('ri,ra->ria', mo_ob, mo_va)
+                    rho_ov_bb = numpy.einsum('ri,ra->ria', mo_ob, mo_vb)
                     rho_ov = ud2tm(rho_ov_aa, rho_ov_ab, rho_ov_ba, rho_ov_bb)
-                    rho_vo = rho_ov.conj()
-                    w_ov = numpy.einsum('tsr,tria->sria', wfxc, rho_ov)
-                    a += lib.einsum('sria,srjb->iajb', w_ov, rho_vo)
-                    b += lib.einsum('sria,srjb->iajb', w_ov, rho_ov)
+                    w_ov = contract_fxc(wfxc, rho_ov)
+                    a_xc, b_xc = contract_ab(w_ov, rho_ov)
+                    a += a_xc
+                    b += b_xc
                 elif ni.collinear[0] == 'c':
                     rho = ni.eval_rho(mol, ao, dm0, mask, xctype, hermi=1, with_lapl=False)
                     fxc = ni.eval_xc_eff(mf.xc, rho, deriv=2)[2]
-                    wv_a, wv_b = weight * fxc.reshape(2,2,-1)
+                    wfxc = weight * fxc.reshape(2,2,-1)
                     mo_oa, mo_va, mo_ob, mo_vb = get_mo_value(ao)
-                    rho_ov_a = numpy.einsum('ri,ra->ria', mo_oa.conj(), mo_va)
-                    rho_ov_b = numpy.einsum('ri,ra->ria', mo_ob.conj(), mo_vb)
-                    rho_vo_a = rho_ov_a.conj()
-                    rho_vo_b = rho_ov_b.conj()
-                    w_ov  = wv_a[:,:,None,None] * rho_ov_a
-                    w_ov += wv_b[:,:,None,None] * rho_ov_b
-                    wa_ov, wb_ov = w_ov
-                    a += lib.einsum('ria,rjb->iajb', wa_ov, rho_vo_a)
-                    a += lib.einsum('ria,rjb->iajb', wb_ov, rho_vo_b)
-                    b += lib.einsum('ria,rjb->iajb', wa_ov, rho_ov_a)
-                    b += lib.einsum('ria,rjb->iajb', wb_ov, rho_ov_b)
+                    rho_ov = numpy.empty((2,weight.size,nocc,nvir), xc_dtype)
+                    numpy.einsum('ri,ra->ria', mo_oa, mo_va, out=rho_ov[0])
+                    numpy.einsum('ri,ra->ria', mo_ob, mo_vb, out=rho_ov[1])
+                    w_ov = contract_fxc(wfxc, rho_ov)
+                    a_xc, b_xc = contract_ab(w_ov, rho_ov)
+                    a += a_xc
+                    b += b_xc
                 else:
                     raise NotImplementedError(ni.collinear)
 
@@ -240,37 +374,36 @@ def get_ab(mf, mo_energy=None, mo_coeff=None, mo_occ=None):
                     wfxc = weight * fxc
                     wr, wmx, wmy, wmz = weight * fxc
                     mo_oa, mo_va, mo_ob, mo_vb = get_mo_value(ao)
-                    rho_ov_aa = numpy.einsum('ri,xra->xria', mo_oa[0].conj(), mo_va)
-                    rho_ov_ab = numpy.einsum('ri,xra->xria', mo_oa[0].conj(), mo_vb)
-                    rho_ov_ba = numpy.einsum('ri,xra->xria', mo_ob[0].conj(), mo_va)
-                    rho_ov_bb = numpy.einsum('ri,xra->xria', mo_ob[0].conj(), mo_vb)
-                    rho_ov_aa[1:4] += numpy.einsum('xri,ra->xria', mo_oa[1:4].conj(), mo_va[0])
-                    rho_ov_ab[1:4] += numpy.einsum('xri,ra->xria', mo_oa[1:4].conj(), mo_vb[0])
-                    rho_ov_ba[1:4] += numpy.einsum('xri,ra->xria', mo_ob[1:4].conj(), mo_va[0])
-                    rho_ov_bb[1:4] += numpy.einsum('xri,ra->xria', mo_ob[1:4].conj(), mo_vb[0])
+                    rho_ov_aa = numpy.einsum('ri,xra->xria', mo_oa[0], mo_va)
+                    rho_ov_ab = numpy.einsum('ri,xra->xria', mo_oa[0], mo_vb)
+                    rho_ov_ba = numpy.einsum('ri,xra->xria', mo_ob[0], mo_va)
+                    rho_ov_bb = numpy.einsum('ri,xra->xria', mo_ob[0], mo_vb)
+                    rho_ov_aa[1:4] += numpy.einsum('xri,ra->xria', mo_oa[1:4], mo_va[0])
+                    rho_ov_ab[1:4] += numpy.einsum('xri,ra->xria', mo_oa[1:4], mo_vb[0])
+                    rho_ov_ba[1:4] += numpy.einsum('xri,ra->xria', mo_ob[1:4], mo_va[0])
+                    rho_ov_bb[1:4] += numpy.einsum('xri,ra->xria', mo_ob[1:4], mo_vb[0])
                     rho_ov = ud2tm(rho_ov_aa, rho_ov_ab, rho_ov_ba, rho_ov_bb)
-                    rho_vo = rho_ov.conj()
-                    w_ov = numpy.einsum('txsyr,txria->syria', wfxc, rho_ov)
-                    a += lib.einsum('syria,syrjb->iajb', w_ov, rho_vo)
-                    b += lib.einsum('syria,syrjb->iajb', w_ov, rho_ov)
+                    w_ov = contract_fxc(wfxc, rho_ov)
+                    a_xc, b_xc = contract_ab(w_ov, rho_ov)
+                    a += a_xc
+                    b += b_xc
                 elif ni.collinear[0] == 'c':
                     rho = ni.eval_rho(mol, ao, dm0, mask, xctype, hermi=1, with_lapl=False)
                     fxc = ni.eval_xc_eff(mf.xc, rho, deriv=2)[2]
-                    wv_a, wv_b = weight * fxc
+                    wfxc = weight * fxc
                     mo_oa, mo_va, mo_ob, mo_vb = get_mo_value(ao)
-                    rho_ov_a = numpy.einsum('xri,ra->xria', mo_oa.conj(), mo_va[0])
-                    rho_ov_b = numpy.einsum('xri,ra->xria', mo_ob.conj(), mo_vb[0])
-                    rho_ov_a[1:4] += numpy.einsum('ri,xra->xria', mo_oa[0].conj(), mo_va[1:4])
-                    rho_ov_b[1:4] += numpy.einsum('ri,xra->xria', mo_ob[0].conj(), mo_vb[1:4])
-                    rho_vo_a = rho_ov_a.conj()
-                    rho_vo_b = rho_ov_b.conj()
-                    w_ov  = numpy.einsum('xsyr,xria->syria', wv_a, rho_ov_a)
-                    w_ov += numpy.einsum('xsyr,xria->syria', wv_b, rho_ov_b)
-                    wa_ov, wb_ov = w_ov
-                    a += lib.einsum('xria,xrjb->iajb', wa_ov, rho_vo_a)
-                    a += lib.einsum('xria,xrjb->iajb', wb_ov, rho_vo_b)
-                    b += lib.einsum('xria,xrjb->iajb', wa_ov, rho_ov_a)
-                    b += lib.einsum('xria,xrjb->iajb', wb_ov, rho_ov_b)
+                    # Build the alpha and beta products in place in one
+                    # buffer to avoid per-spin temporaries
+                    rho_ov = numpy.empty((2,4,weight.size,nocc,nvir), xc_dtype)
+                    rho_ov_a, rho_ov_b = rho_ov
+                    numpy.einsum('xri,ra->xria', mo_oa, mo_va[0], out=rho_ov_a)
+                    numpy.einsum('xri,ra->xria', mo_ob, mo_vb[0], out=rho_ov_b)
+                    rho_ov_a[1:4] += numpy.einsum('ri,xra->xria', mo_oa[0], mo_va[1:4])
+                    rho_ov_b[1:4] += numpy.einsum('ri,xra->xria', mo_ob[0], mo_vb[1:4])
+                    w_ov = contract_fxc(wfxc, rho_ov)
+                    a_xc, b_xc = contract_ab(w_ov, rho_ov)
+                    a += a_xc
+                    b += b_xc
                 else:
                     raise NotImplementedError(ni.collinear)
 
@@ -291,49 +424,47 @@ def get_ab(mf, mo_energy=None, mo_coeff=None, mo_occ=None):
                     wfxc = weight * fxc
                     wr, wmx, wmy, wmz = weight * fxc
                     mo_oa, mo_va, mo_ob, mo_vb = get_mo_value(ao)
-                    rho_ov_aa = numpy.einsum('ri,xra->xria', mo_oa[0].conj(), mo_va)
-                    rho_ov_ab = numpy.einsum('ri,xra->xria', mo_oa[0].conj(), mo_vb)
-                    rho_ov_ba = numpy.einsum('ri,xra->xria', mo_ob[0].conj(), mo_va)
-                    rho_ov_bb = numpy.einsum('ri,xra->xria', mo_ob[0].conj(), mo_vb)
-                    rho_ov_aa[1:4] += numpy.einsum('xri,ra->xria', mo_oa[1:4].conj(), mo_va[0])
-                    rho_ov_ab[1:4] += numpy.einsum('xri,ra->xria', mo_oa[1:4].conj(), mo_vb[0])
-                    rho_ov_ba[1:4] += numpy.einsum('xri,ra->xria', mo_ob[1:4].conj(), mo_va[0])
-                    rho_ov_bb[1:4] += numpy.einsum('xri,ra->xria', mo_ob[1:4].conj(), mo_vb[0])
-                    tau_ov_aa = numpy.einsum('xri,xra->ria', mo_oa[1:4].conj(), mo_va[1:4]) * .5
-                    tau_ov_ab = numpy.einsum('xri,xra->ria', mo_oa[1:4].conj(), mo_vb[1:4]) * .5
-                    tau_ov_ba = numpy.einsum('xri,xra->ria', mo_ob[1:4].conj(), mo_va[1:4]) * .5
-                    tau_ov_bb = numpy.einsum('xri,xra->ria', mo_ob[1:4].conj(), mo_vb[1:4]) * .5
+                    rho_ov_aa = numpy.einsum('ri,xra->xria', mo_oa[0], mo_va)
+                    rho_ov_ab = numpy.einsum('ri,xra->xria', mo_oa[0], mo_vb)
+                    rho_ov_ba = numpy.einsum('ri,xra->xria', mo_ob[0], mo_va)
+                    rho_ov_bb = numpy.einsum('ri,xra->xria', mo_ob[0], mo_vb)
+                    rho_ov_aa[1:4] += numpy.einsum('xri,ra->xria', mo_oa[1:4], mo_va[0])
+                    rho_ov_ab[1:4] += numpy.einsum('xri,ra->xria', mo_oa[1:4], mo_vb[0])
+                    rho_ov_ba[1:4] += numpy.einsum('xri,ra->xria', mo_ob[1:4], mo_va[0])
+                    rho_ov_bb[1:4] += numpy.einsum('xri,ra->xria', mo_ob[1:4], mo_vb[0])
+                    tau_ov_aa = numpy.einsum('xri,xra->ria', mo_oa[1:4], mo_va[1:4]) * .5
+                    tau_ov_ab = numpy.einsum('xri,xra->ria', mo_oa[1:4], mo_vb[1:4]) * .5
+                    tau_ov_ba = numpy.einsum('xri,xra->ria', mo_ob[1:4], mo_va[1:4]) * .5
+                    tau_ov_bb = numpy.einsum('xri,xra->ria', mo_ob[1:4], mo_vb[1:4]) * .5
                     rho_ov_aa = numpy.vstack([rho_ov_aa, tau_ov_aa[numpy.newaxis]])
                     rho_ov_ab = numpy.vstack([rho_ov_ab, tau_ov_ab[numpy.newaxis]])
                     rho_ov_ba = numpy.vstack([rho_ov_ba, tau_ov_ba[numpy.newaxis]])
                     rho_ov_bb = numpy.vstack([rho_ov_bb, tau_ov_bb[numpy.newaxis]])
                     rho_ov = ud2tm(rho_ov_aa, rho_ov_ab, rho_ov_ba, rho_ov_bb)
-                    rho_vo = rho_ov.conj()
-                    w_ov = numpy.einsum('txsyr,txria->syria', wfxc, rho_ov)
-                    a += lib.einsum('syria,syrjb->iajb', w_ov, rho_vo)
-                    b += lib.einsum('syria,syrjb->iajb', w_ov, rho_ov)
+                    w_ov = contract_fxc(wfxc, rho_ov)
+                    a_xc, b_xc = contract_ab(w_ov, rho_ov)
+                    a += a_xc
+                    b += b_xc
                 elif ni.collinear[0] == 'c':
                     rho = ni.eval_rho(mol, ao, dm0, mask, xctype, hermi=1, with_lapl=False)
                     fxc = ni.eval_xc_eff(mf.xc, rho, deriv=2)[2]
-                    wv_a, wv_b = weight * fxc
+                    wfxc = weight * fxc
                     mo_oa, mo_va, mo_ob, mo_vb = get_mo_value(ao)
-                    rho_ov_a = numpy.einsum('xri,ra->xria', mo_oa.conj(), mo_va[0])
-                    rho_ov_b = numpy.einsum('xri,ra->xria', mo_ob.conj(), mo_vb[0])
-                    rho_ov_a[1:4] += numpy.einsum('ri,xra->xria', mo_oa[0].conj(), mo_va[1:4])
-                    rho_ov_b[1:4] += numpy.einsum('ri,xra->xria', mo_ob[0].conj(), mo_vb[1:4])
-                    tau_ov_a = numpy.einsum('xri,xra->ria', mo_oa[1:4].conj(), mo_va[1:4]) * .5
-                    tau_ov_b = numpy.einsum('xri,xra->ria', mo_ob[1:4].conj(), mo_vb[1:4]) * .5
-                    rho_ov_a = numpy.vstack([rho_ov_a, tau_ov_a[numpy.newaxis]])
-                    rho_ov_b = numpy.vstack([rho_ov_b, tau_ov_b[numpy.newaxis]])
-                    rho_vo_a = rho_ov_a.conj()
-                    rho_vo_b = rho_ov_b.conj()
-                    w_ov  = numpy.einsum('xsyr,xria->syria', wv_a, rho_ov_a)
-                    w_ov += numpy.einsum('xsyr,xria->syria', wv_b, rho_ov_b)
-                    wa_ov, wb_ov = w_ov
-                    a += lib.einsum('xria,xrjb->iajb', wa_ov, rho_vo_a)
-                    a += lib.einsum('xria,xrjb->iajb', wb_ov, rho_vo_b)
-                    b += lib.einsum('xria,xrjb->iajb', wa_ov, rho_ov_a)
-                    b += lib.einsum('xria,xrjb->iajb', wb_ov, rho_ov_b)
+                    # Build the alpha and beta products in place in one
+                    # buffer to avoid per-spin temporaries
+                    rho_ov = numpy.empty((2,5,weight.size,nocc,nvir), xc_dtype)
+                    rho_ov_a, rho_ov_b = rho_ov
+                    numpy.einsum('xri,ra->xria', mo_oa, mo_va[0], out=rho_ov_a[:4])
+                    numpy.einsum('xri,ra->xria', mo_ob, mo_vb[0], out=rho_ov_b[:4])
+                    rho_ov_a[1:4] += numpy.einsum('ri,xra->xria', mo_oa[0], mo_va[1:4])
+                    rho_ov_b[1:4] += numpy.einsum('ri,xra->xria', mo_ob[0], mo_vb[1:4])
+                    numpy.einsum('xri,xra->ria', mo_oa[1:4], mo_va[1:4], out=rho_ov_a[4])
+                    numpy.einsum('xri,xra->ria', mo_ob[1:4], mo_vb[1:4], out=rho_ov_b[4])
+                    rho_ov[:,4] *= .5
+                    w_ov = contract_fxc(wfxc, rho_ov)
+                    a_xc, b_xc = contract_ab(w_ov, rho_ov)
+                    a += a_xc
+                    b += b_xc
                 else:
                     raise NotImplementedError(ni.collinear)
 
@@ -384,8 +515,8 @@ class TDA(TDBase):
 
         mo_energy = mf.mo_energy
         mo_occ = mf.mo_occ
-        occidx = numpy.where(mo_occ==1)[0]
-        viridx = numpy.where(mo_occ==0)[0]
+        occidx = (mo_occ==1).nonzero()[0]
+        viridx = (mo_occ==0).nonzero()[0]
         e_ia = mo_energy[viridx] - mo_energy[occidx,None]
 
         if wfnsym is not None and mf.mol.symmetry:
@@ -399,13 +530,12 @@ class TDA(TDBase):
         nov = e_ia.size
         nstates = min(nstates, nov)
         e_ia = e_ia.ravel()
-        e_threshold = numpy.sort(e_ia)[nstates-1]
+        e_threshold = numpy.partition(e_ia, nstates-1)[nstates-1]
         e_threshold += self.deg_eia_thresh
 
-        idx = numpy.where(e_ia <= e_threshold)[0]
+        idx = (e_ia <= e_threshold).nonzero()[0]
         x0 = numpy.zeros((idx.size, nov))
-        for i, j in enumerate(idx):
-            x0[i, j] = 1  # Koopmans' excitations
+        x0[numpy.arange(idx.size), idx] = 1  # Koopmans' excitations
         return x0
 
     def kernel(self, x0=None, nstates=None):
@@ -425,7 +555,7 @@ class TDA(TDBase):
         precond = self.get_precond(hdiag)
 
         def pickeig(w, v, nroots, envs):
-            idx = numpy.where(w > self.positive_eig_threshold)[0]
+            idx = (w > self.positive_eig_threshold).nonzero()[0]
             return w[idx], v[:,idx], idx
 
         if x0 is None:
@@ -467,12 +597,14 @@ def gen_tdhf_operation(mf, fock_ao=None, wfnsym=None):
     mo_energy = mf.mo_energy
     mo_occ = mf.mo_occ
     nao, nmo = mo_coeff.shape
-    occidx = numpy.where(mo_occ == 1)[0]
-    viridx = numpy.where(mo_occ == 0)[0]
+    occidx = (mo_occ == 1).nonzero()[0]
+    viridx = (mo_occ == 0).nonzero()[0]
     nocc = len(occidx)
     nvir = len(viridx)
     orbv = mo_coeff[:,viridx]
     orbo = mo_coeff[:,occidx]
+    orbv_c = orbv.conj()
+    orbo_c = orbo.conj()
 
     if wfnsym is not None and mol.symmetry:
         if isinstance(wfnsym, str):
@@ -481,51 +613,64 @@ def gen_tdhf_operation(mf, fock_ao=None, wfnsym=None):
         orbsym = ghf_symm.get_orbsym(mol, mo_coeff)
         orbsym_in_d2h = numpy.asarray(orbsym) % 10  # convert to D2h irreps
         sym_forbid = (orbsym_in_d2h[occidx,None] ^ orbsym_in_d2h[viridx]) != wfnsym
+        sym_allowed = ~sym_forbid
+        # Scratch buffer for the symmetry restricted trial vectors
+        sym_buf = numpy.empty(0)
 
     #dm0 = mf.make_rdm1(mo_coeff, mo_occ)
     #fock_ao = mf.get_hcore() + mf.get_veff(mol, dm0)
     #fock = reduce(numpy.dot, (mo_coeff.T, fock_ao, mo_coeff))
     #foo = fock[occidx[:,None],occidx]
     #fvv = fock[viridx[:,None],viridx]
-    foo = numpy.diag(mo_energy[occidx])
-    fvv = numpy.diag(mo_energy[viridx])
+    e_ia = mo_energy[viridx] - mo_energy[occidx,None]
 
-    hdiag = fvv.diagonal() - foo.diagonal()[:,None]
+    hdiag = e_ia.copy()
     if wfnsym is not None and mol.symmetry:
         hdiag[sym_forbid] = 0
     hdiag = numpy.hstack((hdiag.ravel(), -hdiag.ravel())).real
 
     mo_coeff = numpy.asarray(numpy.hstack((orbo,orbv)), order='F')
-    vresp = mf.gen_response(hermi=0)
+    vresp = _gen_vresp(mf)
 
     def vind(xys):
+        nonlocal sym_buf
         xys = numpy.asarray(xys).reshape(-1,2,nocc,nvir)
         if wfnsym is not None and mol.symmetry:
             # shape(nz,2,nocc,nvir): 2 ~ X,Y
-            xys = numpy.copy(xys)
-            xys[:,:,sym_forbid] = 0
+            if sym_buf.dtype != xys.dtype or sym_buf.size < xys.size:
+                sym_buf = numpy.empty(xys.size, xys.dtype)
+            xys = numpy.multiply(xys, sym_allowed,
+                                 out=sym_buf[:xys.size].reshape(xys.shape))
 
+        nz = xys.shape[0]
         xs, ys = xys.transpose(1,0,2,3)
         # dms = AX + BY
-        dms  = lib.einsum('xov,qv,po->xpq', xs, orbv.conj(), orbo)
-        dms += lib.einsum('xov,pv,qo->xpq', ys, orbv, orbo.conj())
+        # dms = einsum('xov,qv,po->xpq', xs, orbv.conj(), orbo)
+        #     + einsum('xov,pv,qo->xpq', ys, orbv, orbo.conj())
+        # The Y term is the conjugate transpose of the X term evaluated with
+        # ys.conj(). X and Y are transformed in one batch.
+        dms = numpy.vstack((xs, ys.conj()))
+        dms = numpy.tensordot(dms, orbv_c, axes=([2],[1]))
+        dms = numpy.tensordot(orbo, dms, axes=([1],[1])).transpose(1,0,2)
+        dms = dms[:nz] + dms[nz:].conj().transpose(0,2,1)
 
         v1ao = vresp(dms)
-        v1ov = lib.einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
-        v1vo = lib.einsum('xpq,qo,pv->xov', v1ao, orbo, orbv.conj())
-        v1ov += lib.einsum('xqs,sp->xqp', xs, fvv)  # AX
-        v1ov -= lib.einsum('xpr,sp->xsr', xs, foo)  # AX
-        v1vo += lib.einsum('xqs,sp->xqp', ys, fvv.conj())  # (A*)Y
-        v1vo -= lib.einsum('xpr,sp->xsr', ys, foo.conj())  # (A*)Y
+        # v1ov = einsum('xpq,po,qv->xov', v1ao, orbo.conj(), orbv)
+        # v1vo = einsum('xpq,qo,pv->xov', v1ao, orbo, orbv.conj())
+        # v1vo is the conjugate of v1ov evaluated with v1ao^H
+        v1ao = numpy.vstack((v1ao, v1ao.conj().transpose(0,2,1)))
+        v1ao = numpy.matmul(orbo_c.T, v1ao)
+        v1ao = numpy.matmul(v1ao, orbv)
+        # (AX, (-A*)Y) is assembled in place in the output buffer
+        hx = numpy.empty((nz,2,nocc,nvir), numpy.result_type(xys, v1ao))
+        numpy.multiply(xys, e_ia, out=hx)
+        hx[:,0] += v1ao[:nz]  # AX
+        hx[:,1] += v1ao[nz:].conj()  # (A*)Y
 
         if wfnsym is not None and mol.symmetry:
-            v1ov[:,sym_forbid] = 0
-            v1vo[:,sym_forbid] = 0
-
-        # (AX, (-A*)Y)
-        nz = xys.shape[0]
-        hx = numpy.hstack((v1ov.reshape(nz,-1), -v1vo.reshape(nz,-1)))
-        return hx
+            hx *= sym_allowed
+        hx[:,1] *= -1
+        return hx.reshape(nz,-1)
 
     return vind, hdiag
 
@@ -563,8 +708,8 @@ class TDHF(TDBase):
 
         ensure_real = self._scf.mo_coeff.dtype == numpy.double
         def pickeig(w, v, nroots, envs):
-            realidx = numpy.where((abs(w.imag) < REAL_EIG_THRESHOLD) &
-                                  (w.real > self.positive_eig_threshold))[0]
+            realidx = ((abs(w.imag) < REAL_EIG_THRESHOLD) &
+                       (w.real > self.positive_eig_threshold)).nonzero()[0]
             # FIXME: Should the amplitudes be real? It also affects x2c-tdscf
             return lib.linalg_helper._eigs_cmplx2real(w, v, realidx, ensure_real)
 
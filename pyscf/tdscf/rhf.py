@@ -815,13 +815,12 @@ class TDA(TDBase):
         nov = e_ia.size
         nstates = min(nstates, nov)
         e_ia = e_ia.ravel()
-        e_threshold = numpy.sort(e_ia)[nstates-1]
+        e_threshold = numpy.partition(e_ia, nstates-1)[nstates-1]
         e_threshold += self.deg_eia_thresh
 
         idx = numpy.where(e_ia <= e_threshold)[0]
         x0 = numpy.zeros((idx.size, nov))
-        for i, j in enumerate(idx):
-            x0[i, j] = 1  # Koopmans' excitations
+        x0[numpy.arange(idx.size), idx] = 1  # Koopmans' excitations
         return x0
 
     def kernel(self, x0=None, nstates=None):
@@ -112,6 +112,31 @@ class KnownValues(unittest.TestCase):
         mf_m06l.__dict__.update(scf.chkfile.load(mf_lda.chkfile, 'scf'))
         self._check_against_ab_ks_real(tdscf.gks.TDDFT(mf_m06l), -0.49217076039995644, 0.14593146495412246)
 
+    def test_col_ab_ks_complex_trial_vectors(self):
+        # Real orbitals and pure collinear functionals use the hermi=1
+        # response function. Complex trial vectors are split into real and
+        # imaginary parts.
+        self._check_against_ab_ks_real(tdscf.gks.TDDFT(mf_lda), -0.5233726312108345, 0.07876886521779444,
+                                       complex_xy=True)
+        mf_gga = dft.GKS(mol).set(xc='bp86')
+        mf_gga.__dict__.update(scf.chkfile.load(mf_lda.chkfile, 'scf'))
+        self._check_against_ab_ks_real(tdscf.gks.TDDFT(mf_gga), -0.5098652164479021, 0.07332482881746855,
+                                       complex_xy=True)
+
+    def test_ab_xc_single_prec(self):
+        for xc in ('lda,', 'b3lyp5', 'm06l'):
+            mf = dft.GKS(mol).set(xc=xc)
+            mf.__dict__.update(scf.chkfile.load(mf_lda.chkfile, 'scf'))
+            a0, b0 = tdscf.ghf.get_ab(mf)
+            a1, b1 = tdscf.ghf.get_ab(mf, xc_single_prec=True)
+            self.assertEqual(a1.dtype, numpy.double)
+            self.assertEqual(b1.dtype, numpy.double)
+            # Single precision takes effect but the errors are small
+            self.assertTrue(abs(a1 - a0).max() > 0)
+            self.assertTrue(abs(b1 - b0).max() > 0)
+            self.assertAlmostEqual(abs(a1 - a0).max(), 0, 6)
+            self.assertAlmostEqual(abs(b1 - b0).max(), 0, 6)
+
     @unittest.skipIf(mcfun is None, "mcfun library not found.")
     def test_mcol_lda_ab_ks(self):
         self._check_against_ab_ks_complex(mcol_lda.TDDFT(), -0.5670282020105087, 0.4994706435157656)
@@ -130,7 +155,7 @@ class KnownValues(unittest.TestCase):
         mcol_m06l.__dict__.update(scf.chkfile.load(mf_lda.chkfile, 'scf'))
         self._check_against_ab_ks_complex(mcol_m06l.TDDFT(), -0.5215225316715016, 1.9444403387002533)
 
-    def _check_against_ab_ks_real(self, td, refa, refb, places=6):
+    def _check_against_ab_ks_real(self, td, refa, refb, places=6, complex_xy=False):
         mf = td._scf
         a, b = td.get_ab()
         self.assertAlmostEqual(lib.fp(abs(a)), refa, places)
@@ -141,6 +166,8 @@ class KnownValues(unittest.TestCase):
         nvir = numpy.count_nonzero(mf.mo_occ == 0)
         numpy.random.seed(2)
         x, y = xy = numpy.random.random((2,nocc,nvir))
+        if complex_xy:
+            x, y = xy = xy + numpy.random.random((2,nocc,nvir)) * 1j
 
         ax = numpy.einsum('iajb,jb->ia', a, x)
         self.assertAlmostEqual(abs(ax - ftda([x]).reshape(nocc,nvir)).max(), 0, 12)